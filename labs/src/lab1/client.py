@@ -13,9 +13,21 @@
 
 import sys
 import socket
+import select
+import struct
 import json
 import argparse
 
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
 # -----------------------------------------------------------------------------
@@ -41,6 +53,10 @@ parser.add_argument(
     "-i", "--interactive", action="store_true", dest="interactive",
     default=False, help="Interactive session with the fortune database."
 )
+parser.add_argument(
+    "--json", action="store_true", dest="json", default=False,
+    help="Send JSON instead of msgpack to the server (for debugging)."
+)
 parser.add_argument(
     "address", type=address, nargs=1, metavar="addr:port",
     help="Server address."
@@ -48,6 +64,94 @@ parser.add_argument(
 opts = parser.parse_args()
 server_address = opts.address[0]
 
+# -----------------------------------------------------------------------------
+# Wire format
+# -----------------------------------------------------------------------------
+
+# Every message is a 4-byte big-endian length followed by the body. The
+# body is msgpack, or JSON when msgspec is missing or --json is given.
+# This is the framing of Common.orb, repeated here because the client
+# does not need the modules directory to run.
+use_json = opts.json or msgspec is None
+header = struct.Struct(">I")
+
+if not use_json:
+    enc = msgspec.msgpack.Encoder()
+    dec = msgspec.msgpack.Decoder()
+
+# JSON to and from UTF-8 bytes, with orjson when available.
+if orjson is not None:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+else:
+    json_encode = json.JSONEncoder(separators=(",", ":"),
+                                   ensure_ascii=False).encode
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json_encode(obj).encode()
+
+
+def encode(obj):
+    if use_json:
+        return json_dumps(obj)
+    return enc.encode(obj)
+
+
+def decode(buf):
+    if buf[:1] == b"{":
+        return json_loads(buf)
+    return dec.decode(buf)
+
+
+def recv_into(sock, view):
+    """Fill view from the socket, returning the number of bytes read."""
+    got = 0
+    while got < len(view):
+        n = sock.recv_into(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+
+def send_frame(sock, body):
+    """Send body prefixed by its length, in one sendmsg when possible."""
+    head = header.pack(len(body))
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(head + body)
+        return
+    sent = sock.sendmsg([head, body])
+    # Finish a partial write.
+    if sent < len(head):
+        sock.sendall(head[sent:])
+        sock.sendall(body)
+    elif sent < len(head) + len(body):
+        sock.sendall(memoryview(body)[sent - len(head):])
+
+
+def dropped(sock):
+    """Tell whether the server has closed an idle connection, or sent
+    something that no call is waiting for."""
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(0))
+
+
+def recv_frame(sock):
+    """Receive one frame body, or None if the server closed the connection."""
+    head = bytearray(header.size)
+    got = recv_into(sock, memoryview(head))
+    if got == 0:
+        return None
+    if got < len(head):
+        raise EOFError("Connection closed in the middle of a frame")
+    n, = header.unpack(head)
+    body = bytearray(n)
+    if recv_into(sock, memoryview(body)) < n:
+        raise EOFError("Connection closed in the middle of a frame")
+    return body
+
 # -----------------------------------------------------------------------------
 # Auxiliary classes
 # -----------------------------------------------------------------------------
@@ -69,33 +173,72 @@ class DatabaseProxy(object):
 
     """Class that simulates the behavior of the database class."""
 
+    __slots__ = ("address", "socket")
+
     def __init__(self, server_address):
         self.address = server_address
+        self.socket = None
+
+    # Private methods
+
+    def _close(self):
+        self.socket.close()
+        self.socket = None
+
+    def _connect(self):
+        s = socket.create_connection(self.address)
+        # Calls are small and latency bound, do not let Nagle delay them.
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return s
 
     # Public methods
-    
-    def remote_method_invokation(self, method, args=[]):
-        message = json.dumps(
+
+    def remote_method_invokation(self, method, args=None):
+        if args is None:
+            args = ()
+        message = encode(
             {
                 "method": method,
                 "args": args
             })
-        message += "\n"
-        
-        # Open socket and treat as a file stream
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(self.address)
-        worker = s.makefile(mode="rw")
-
-        # Send message to server
-        worker.write(message)
-        worker.flush()
-        
-        # Receive the respons from the server and close the connection
-        response = worker.readline()
-        s.close()
 
-        return json.loads(response)
+        # Keep the connection open between calls. The call is sent again
+        # on a new connection only if the old one failed before the
+        # server could have run it, or if it is a read, which is safe to
+        # repeat.
+        if self.socket is not None and dropped(self.socket):
+            self._close()
+        reused = self.socket is not None
+        while True:
+            if self.socket is None:
+                self.socket = self._connect()
+            try:
+                # Send the message to the server
+                send_frame(self.socket, message)
+            except ConnectionError:
+                self._close()
+                if not reused:
+                    raise
+                reused = False
+                continue
+            except BaseException:
+                self._close()
+                raise
+
+            try:
+                # Receive the response from the server
+                response = recv_frame(self.socket)
+            except BaseException:
+                self._close()
+                raise
+            if response is None:
+                self._close()
+                if reused and method == "read":
+                    reused = False
+                    continue
+                raise EOFError("Connection closed by server")
+            return decode(response)
 
 
     def handle_server_response(self, response):
@@ -116,7 +259,7 @@ class DatabaseProxy(object):
         return self.handle_server_response(response)
         
     def write(self, fortune):
-        response = self.remote_method_invokation("write", [fortune])
+        response = self.remote_method_invokation("write", (fortune,))
         return self.handle_server_response(response)
 
 # -----------------------------------------------------------------------------
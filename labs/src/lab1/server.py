@@ -13,12 +13,12 @@
 
 import threading
 import socket
-import json
 import random
 import argparse
 
 import sys
 sys.path.append("../modules")
+from Common import orb
 from Server.database import Database
 from Server.Lock.readWriteLock import ReadWriteLock
 
@@ -89,7 +89,7 @@ class Server(object):
 class Request(threading.Thread):
 
     """ Class for handling incoming requests.
-        Each request is handled in a separate thread.
+        Each connection is handled in a separate thread.
     """
 
     def __init__(self, db_server, conn, addr):
@@ -101,8 +101,8 @@ class Request(threading.Thread):
 
     # Private methods
 
-    def process_request(self, request):
-        """ Process a JSON formated request, send it to the database, and
+    def process_request(self, value):
+        """ Process a decoded request, send it to the database, and
             return the result.
 
             The request format is:
@@ -111,7 +111,7 @@ class Request(threading.Thread):
                     "args": method_arguments
                 }
 
-            The returned result is a JSON of the following format:
+            The returned result has the following format:
                 -- in case of no error:
                     {
                         "result": method_result
@@ -125,42 +125,42 @@ class Request(threading.Thread):
                     }
         """
         try:
-            value = json.loads(request)
             print(value)
             if (value["method"] == "read"):
-                res = json.dumps(
-                    {
-                        "result": self.db_server.read()
-                    })
+                res = {
+                    "result": self.db_server.read()
+                }
 
             elif (value["method"] == "write"):
-                res = json.dumps(
-                    {
-                        "result": self.db_server.write(value["args"][0])
-                    })
-        
+                res = {
+                    "result": self.db_server.write(value["args"][0])
+                }
+
         except Exception as e:
-            res = json.dumps(
-                {
-                    "error": {
-                        "name": type(e),
-                        "args": e.args
-                    }
-                })        
-            
+            res = {
+                "error": {
+                    "name": type(e).__name__,
+                    "args": e.args
+                }
+            }
+
         return res
 
     def run(self):
         try:
-            # Threat the socket as a file stream.
-            worker = self.conn.makefile(mode="rw")
-            # Read the request in a serialized form (JSON).
-            request = worker.readline()
-            # Process the request.
-            result = self.process_request(request)
-            # Send the result.
-            worker.write(result + '\n')
-            worker.flush()
+            # Serve requests until the client closes the connection.
+            while True:
+                # Read the length-prefixed request.
+                # Messages are framed as by Common.orb, and answered in
+                # the format of the request.
+                request = orb.recv_frame(self.conn)
+                if request is None:
+                    break
+                request, wire = orb._decode(request)
+                # Process the request.
+                result = orb._encode(self.process_request(request), wire)
+                # Send the result.
+                orb.send_frame(self.conn, result)
         except Exception as e:
             # Catch all errors in order to prevent the object from crashing
             # due to bad connections coming from outside.
@@ -189,6 +189,8 @@ try:
     while True:
         try:
             conn, addr = server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             req = Request(sync_db, conn, addr)
             print("Serving a request from {0}".format(addr))
             req.start()
@@ -44,6 +44,10 @@ parser.add_argument(
     "-p", "--peer", metavar="PEER_ID", dest="peer_id", type=int,
     help="The identifier of a particular server peer."
 )
+parser.add_argument(
+    "--json", action="store_true", dest="json", default=False,
+    help="Send JSON instead of msgpack to the server (for debugging)."
+)
 opts = parser.parse_args()
 
 server_type = opts.type
@@ -55,7 +59,7 @@ assert server_type != "object", "Change the object type to something unique!"
 # -----------------------------------------------------------------------------
 
 # Connect to the name service to obtain the address of the server.
-ns = orb.Stub(name_service_address)
+ns = orb.Stub(name_service_address, orb.LINE_JSON)
 
 if server_id is None:
     server_address = tuple(ns.require_any(server_type))
@@ -65,7 +69,8 @@ else:
 print("Connecting to server: {}".format(server_address))
 
 # Create the database object.
-db = orb.Stub(server_address)
+db = orb.Stub(server_address, orb.JSON if opts.json else orb.DEFAULT_WIRE,
+              idempotent=("read",))
 
 if not opts.interactive:
     # Run in the normal mode.
@@ -78,7 +78,7 @@ class Server(orb.Peer):
         self.peer_list = PeerList(self)
         self.distributed_lock = DistributedLock(self, self.peer_list)
         self.drwlock = DistributedReadWriteLock(self.distributed_lock)
-        self.db = database.Database(db_file)
+        self.db = database.CachedDatabase(db_file)
         self.dispatched_calls = {
             "display_peers":      self.peer_list.display_peers,
             "acquire":            self.distributed_lock.acquire,
@@ -7,9 +7,30 @@
 # Copyright 2012-2017 Linkoping University
 # -----------------------------------------------------------------------------
 
+import asyncio
+import itertools
+import functools
+import ipaddress
 import threading
 import socket
+import select
+import selectors
+import struct
 import json
+import queue
+import time
+import collections
+from concurrent.futures import Executor, Future
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 """Object Request Broker
 
@@ -22,13 +43,106 @@ objects that communicate via networks. This infrastructure consists of:
 --  Skeleton ::
         Used to listen to incoming connections and forward them to the
         main object.
+--  AsyncStub ::
+        Variant of Stub whose calls are coroutines on an asyncio event
+        loop.
 --  Peer ::
         Class that implements basic bidirectional (Stub/Skeleton)
         communication. Any object wishing to transparently interact with
         remote objects should extend this class.
 
+Messages are sent as frames: a 4-byte big-endian length followed by
+the serialized body. The body is msgpack when msgspec is installed and
+JSON otherwise; the receiving side tells them apart by the first byte
+and answers in the same format. The name service still speaks
+newline-delimited JSON, which a Skeleton also accepts since no frame
+header can start with '{'.
+
 """
 
+# Wire formats understood by Stub and Skeleton.
+MSGPACK = 0
+JSON = 1
+LINE_JSON = 2
+
+DEFAULT_WIRE = JSON if msgspec is None else MSGPACK
+
+# AsyncStub.timeout() is RTT_FACTOR times the mean round trip time of
+# the last RTT_SAMPLES calls, but never less than MIN_TIMEOUT seconds.
+# Until a call has been timed, it is DEFAULT_TIMEOUT.
+RTT_FACTOR = 4
+RTT_SAMPLES = 8
+MIN_TIMEOUT = 0.05
+DEFAULT_TIMEOUT = 2.0
+
+_header = struct.Struct(">I")
+
+if msgspec is not None:
+    _enc = msgspec.msgpack.Encoder()
+    _dec = msgspec.msgpack.Decoder()
+
+# JSON to and from UTF-8 bytes, with orjson when available.
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    _json_encode = json.JSONEncoder(separators=(",", ":"),
+                                    ensure_ascii=False).encode
+    # json.loads already reuses a module-level decoder and takes bytes.
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return _json_encode(obj).encode()
+
+
+def _encode(obj, wire):
+    if wire == MSGPACK:
+        return _enc.encode(obj)
+    return _json_dumps(obj)
+
+
+def _decode(buf):
+    """Decode a frame body, returning the value and its wire format."""
+    if buf[:1] == b"{":
+        if isinstance(buf, memoryview):
+            # json.loads does not take memoryviews.
+            buf = buf.tobytes()
+        return _json_loads(buf), JSON
+    if msgspec is None:
+        raise CommunicationError("CommunicationError",
+                                 ["Received msgpack but msgspec is missing"])
+    return _dec.decode(buf), MSGPACK
+
+
+def _recv_into(sock, view):
+    """Fill view from the socket, returning the number of bytes read."""
+    got = 0
+    while got < len(view):
+        n = sock.recv_into(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+
+def _recv_line(sock):
+    """Receive one newline-terminated message, without the newline.
+
+    Only used for one message per connection, so bytes past the newline
+    are not kept.
+
+    """
+    buf = bytearray()
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise EOFError("Connection closed by peer")
+        end = chunk.find(b"\n")
+        if end >= 0:
+            buf += chunk[:end]
+            return buf
+        buf += chunk
+
 
 class CommunicationError(Exception):
     
@@ -42,116 +156,524 @@ class CommunicationError(Exception):
         return self.type 
 
 
+def send_frame(sock, body):
+    """Send body prefixed by its length.
+
+    Header and body go to the kernel together with sendmsg, without
+    concatenating them first, where the platform supports it.
+
+    """
+    head = _header.pack(len(body))
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(head + body)
+        return
+    sent = sock.sendmsg([head, body])
+    # Finish a partial write.
+    if sent < len(head):
+        sock.sendall(head[sent:])
+        sock.sendall(body)
+    elif sent < len(head) + len(body):
+        sock.sendall(memoryview(body)[sent - len(head):])
+
+
+_local = threading.local()
+
+
+def _buffers(n):
+    """Return this thread's header and body receive buffers, the body
+    one holding at least n bytes.
+
+    Bodies larger than the kept 64 KiB buffer get a fresh one, so that
+    a single large call does not pin its memory in every thread.
+
+    """
+    if not hasattr(_local, "head"):
+        _local.head = bytearray(_header.size)
+        _local.body = bytearray(65536)
+    if len(_local.body) < n:
+        return _local.head, bytearray(n)
+    return _local.head, _local.body
+
+
+def recv_frame(sock, reuse=False):
+    """Receive one frame body.
+
+    Returns None if the connection was closed cleanly before the frame
+    started. With reuse, the frame is read into buffers kept by the
+    calling thread and a memoryview is returned, which is only valid
+    until the thread's next recv_frame(reuse=True).
+
+    """
+    head = _buffers(0)[0] if reuse else bytearray(_header.size)
+    got = _recv_into(sock, memoryview(head))
+    if got == 0:
+        return None
+    if got < len(head):
+        raise EOFError("Connection closed in the middle of a frame")
+    n, = _header.unpack(head)
+    if reuse:
+        body = memoryview(_buffers(n)[1])[:n]
+    else:
+        body = memoryview(bytearray(n))
+    if _recv_into(sock, body) < n:
+        raise EOFError("Connection closed in the middle of a frame")
+    return body if reuse else body.obj
+
+
+def _readable(sock, timeout):
+    """Wait up to timeout seconds for sock to have something to read."""
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(timeout * 1000))
+
+
+def _rtt_timeout(rtt):
+    """Return the call timeout for the given round trip times."""
+    if not rtt:
+        return DEFAULT_TIMEOUT
+    return max(MIN_TIMEOUT, RTT_FACTOR * sum(rtt) / len(rtt))
+
+
+def _dropped(sock):
+    """Tell whether an idle connection can no longer be used.
+
+    That is the case once the other end has closed it, or if it has
+    sent anything while no call was waiting for it.
+
+    """
+    return _readable(sock, 0)
+
+
+def _configure(sock):
+    """Set the options used on every RPC connection."""
+    # Calls are small and latency bound, do not let Nagle delay them.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+class ConnectionPool(object):
+
+    """Pool of open connections to remote objects, keyed by address.
+
+    Idle sockets are kept in a LIFO queue per address, so the most
+    recently used one (the most likely to still be alive) is reused
+    first. At most max_idle sockets are kept per address, and idle
+    sockets older than ttl seconds are closed. The number of sockets in
+    use is not bounded: a call may block until another call to the
+    same address has been made, so callers must never wait for a
+    free socket.
+
+    """
+
+    def __init__(self, max_idle=4, ttl=30.0):
+        self.max_idle = max_idle
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def _host(self, address):
+        with self.lock:
+            if address not in self.idle:
+                self.idle[address] = queue.LifoQueue()
+            return self.idle[address]
+
+    def acquire(self, address):
+        """Return a connected socket and whether it is a reused one."""
+        idle = self._host(address)
+        while True:
+            try:
+                sock, released = idle.get_nowait()
+            except queue.Empty:
+                break
+            if (time.monotonic() - released < self.ttl and
+                    not _dropped(sock)):
+                return sock, True
+            sock.close()
+
+        sock = socket.create_connection(address)
+        _configure(sock)
+        return sock, False
+
+    def release(self, address, sock):
+        """Give back a healthy socket for later reuse."""
+        idle = self._host(address)
+        if idle.qsize() < self.max_idle:
+            idle.put((sock, time.monotonic()))
+        else:
+            sock.close()
+
+    def discard(self, address, sock):
+        """Close a socket that can no longer be used."""
+        sock.close()
+
+
+default_pool = ConnectionPool()
+
+
+def _server_result(response):
+    """Return the result of a call, or raise the error it ended with."""
+    if ("result" in response):
+        return response["result"]
+    elif ("error" in response):
+        # Get the type of the error and state it to be a subclass of "Exception"
+        ex = type(response["error"]["name"], (Exception, ), {})
+        # Raise said exception
+        raise ex(response["error"]["args"])
+    else:
+        # If something undefined happened
+        raise CommunicationError("CommunicationError", ["Something went wrong with the communication"])
+
+
 class Stub(object):
 
     """ Stub for generic objects distributed over the network.
 
     This is  wrapper object for a socket.
 
+    A call is sent again on a fresh connection only when it cannot
+    have run: the pooled connection it was sent on failed before the
+    whole call had been written. Methods listed in idempotent may also
+    be sent again when the server closes a pooled connection without
+    answering.
+
     """
 
-    def __init__(self, address):
-        self.address = tuple(address)
+    # Keep the attributes in slots; any other name read on a stub is a
+    # remote method and goes to __getattr__.
+    __slots__ = ("address", "wire", "pool", "idempotent", "_cache")
 
+    def __init__(self, address, wire=DEFAULT_WIRE, idempotent=()):
+        self.address = tuple(address)
+        self.wire = wire
+        self.pool = default_pool
+        self.idempotent = frozenset(idempotent)
+        # Remote methods already looked up, by name.
+        self._cache = {}
+
+    def _line_invokation(self, message):
+        """One call per connection, as expected by the name service."""
+        s = socket.create_connection(self.address)
+        try:
+            s.sendall(_json_dumps(message) + b"\n")
+            return _json_loads(_recv_line(s))
+        finally:
+            s.close()
 
-        
     def remote_method_invokation(self, method, *args):
-        message = json.dumps(
-            {
-                "method": method,
-                "args": args
-            })
-        message += "\n"
-        #print(method)
-        #print(args)
-
-        # Open socket and treat as a file stream
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(self.address)
-        worker = s.makefile(mode="rw")
-
-        # Send message to server
-        worker.write(message)
-        worker.flush()
-        
-        # Receive the respons from the server and close the connection
-        response = worker.readline()
-        s.close()
-        return json.loads(response)
+        message = {
+            "method": method,
+            "args": args
+        }
+        if self.wire == LINE_JSON:
+            return self._line_invokation(message)
+
+        body = _encode(message, self.wire)
+        while True:
+            s, reused = self.pool.acquire(self.address)
+            try:
+                # Send the message to the server
+                send_frame(s, body)
+            except ConnectionError:
+                self.pool.discard(self.address, s)
+                if reused:
+                    # The server did not get the whole call, so it has
+                    # not run it; try a fresh connection.
+                    continue
+                raise
+            except BaseException:
+                self.pool.discard(self.address, s)
+                raise
+
+            try:
+                # Receive the response from the server
+                frame = recv_frame(s)
+                if frame is not None:
+                    response = _decode(frame)[0]
+            except BaseException:
+                self.pool.discard(self.address, s)
+                raise
+            if frame is None:
+                self.pool.discard(self.address, s)
+                # The server closed the connection without answering. The
+                # call may have run all the same, so only send it again
+                # if that is harmless.
+                if reused and method in self.idempotent:
+                    continue
+                raise EOFError("Connection closed by peer")
+            self.pool.release(self.address, s)
+            return response
 
 
     def handle_server_response(self, response):
-        if ("result" in response):
-            return response["result"]
-        elif ("error" in response):
-            # Get the type of the error and state it to be a subclass of "Exception"
-            ex = type(response["error"]["name"], (Exception, ), {})
-            # Raise said exception
-            raise ex(response["error"]["args"])
-        else:
-            # If something undefined happened
-            raise CommunicationError("CommunicationError", ["Something went wrong with the communication"])
-            
+        return _server_result(response)
 
     def _rmi(self, method, *args):
         return self.handle_server_response(self.remote_method_invokation(method, *args))
 
     def __getattr__(self, attr):
         """Forward call to name over the network at the given address."""
+        try:
+            return self._cache[attr]
+        except KeyError:
+            pass
+
         def rmi_call(*args):
             return self._rmi(attr, *args)
+        rmi_call.__name__ = rmi_call.__qualname__ = attr
+        self._cache[attr] = rmi_call
         return rmi_call
 
 
-class Request(threading.Thread):
+class AsyncStub(object):
 
-    """Run the incoming requests on the owner object of the skeleton."""
+    """Stub whose remote calls are coroutines.
 
-    def __init__(self, owner, conn, addr):
-        threading.Thread.__init__(self)
-        self.addr = addr
-        self.conn = conn
-        self.owner = owner
-        self.daemon = True
+    await stub.method(*args) calls method on the remote object through
+    asyncio streams, so many calls can be in flight from one thread.
+    Idle connections are kept by the stub and reused; they belong to
+    the event loop that opened them, so a given AsyncStub must only be
+    used from one loop. Calls are sent again under the same conditions
+    as in Stub.
 
-    def process_request(self, request):
-        try:
-            value = json.loads(request)
-            method = getattr(self.owner, value['method'])
-            res = json.dumps(
-                {
-                    "result": method(*value['args'])
-                })
-        
-        except Exception as e:
-            res = json.dumps(
-                {
-                    "error": {
-                        "name": type(e),
-                        "args": e.args
-                    }
-                })        
-            
-        return res
+    Calls are timed, and timeout() follows their recent round trip
+    times. It is meant for telling a server that is down from a slow
+    one: a call may still have been delivered after it has run out.
+
+    """
+
+    def __init__(self, address, wire=DEFAULT_WIRE, max_idle=4,
+                 idempotent=()):
+        self.address = tuple(address)
+        self.wire = wire
+        self.max_idle = max_idle
+        self.idempotent = frozenset(idempotent)
+        self.idle = []
+        self._rtt = collections.deque(maxlen=RTT_SAMPLES)
+
+    def timeout(self):
+        """Return how long a call may take before the server is taken
+        to be down, in seconds."""
+        return _rtt_timeout(self._rtt)
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(*self.address)
+        _configure(writer.get_extra_info("socket"))
+        return reader, writer
+
+    async def remote_method_invokation(self, method, *args):
+        body = _encode(
+            {
+                "method": method,
+                "args": args
+            }, self.wire)
+        while True:
+            reused = bool(self.idle)
+            if reused:
+                reader, writer = self.idle.pop()
+                if reader.at_eof() or writer.is_closing():
+                    # Closed by the server while idle
+                    writer.close()
+                    continue
+            else:
+                reader, writer = await self._connect()
+            start = time.perf_counter()
+            try:
+                # Send the length-prefixed message to the server
+                writer.write(_header.pack(len(body)))
+                writer.write(body)
+                await writer.drain()
+            except ConnectionError:
+                writer.close()
+                if reused:
+                    # The server did not get the whole call, so it has
+                    # not run it; try a fresh connection.
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+            try:
+                # Receive the response from the server
+                n, = _header.unpack(await reader.readexactly(_header.size))
+                response = _decode(await reader.readexactly(n))[0]
+            except asyncio.IncompleteReadError as e:
+                writer.close()
+                # The server closed the connection without answering. The
+                # call may have run all the same, so only send it again
+                # if that is harmless.
+                if not e.partial and reused and method in self.idempotent:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            self._rtt.append(time.perf_counter() - start)
+            if len(self.idle) < self.max_idle:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+            return response
+
+    def close(self):
+        """Close the idle connections. Those of calls still running are
+        closed when the calls end, instead of being kept."""
+        self.max_idle = 0
+        while self.idle:
+            self.idle.pop()[1].close()
+
+    def __getattr__(self, attr):
+        """Forward call to name over the network at the given address."""
+        async def rmi_call(*args):
+            return _server_result(
+                await self.remote_method_invokation(attr, *args))
+        rmi_call.__name__ = rmi_call.__qualname__ = attr
+        # Later lookups find it in the instance and skip __getattr__.
+        setattr(self, attr, rmi_call)
+        return rmi_call
+
+
+class EncodedResult(object):
+
+    """Method result whose response is encoded once and then reused.
+
+    A method served by a Skeleton may return one of these instead of a
+    plain value: the {"result": value} body is then encoded the first
+    time it is needed in each wire format and sent as is on later
+    calls.
+
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.bodies = {}
+
+    def body(self, wire):
+        body = self.bodies.get(wire)
+        if body is None:
+            body = self.bodies[wire] = _encode({"result": self.value}, wire)
+        return body
+
+
+def _encode_response(res, wire):
+    """Encode the response built by _process_request."""
+    result = res.get("result")
+    if isinstance(result, EncodedResult):
+        if wire != LINE_JSON:
+            return result.body(wire)
+        res["result"] = result.value
+    if wire == LINE_JSON:
+        return _json_dumps(res) + b"\n"
+    return _encode(res, wire)
+
+
+def _process_request(owner, value):
+    """Run the request on the owner object and build the response."""
+    try:
+        method = getattr(owner, value['method'])
+        res = {
+            "result": method(*value['args'])
+        }
+
+    except Exception as e:
+        res = {
+            "error": {
+                "name": type(e).__name__,
+                "args": e.args
+            }
+        }
+    return res
+
+
+class _WorkerPool(Executor):
+
+    """Executor starting a thread whenever no idle one can take a call.
+
+    The methods of a skeleton's owner may block until another call to
+    the same skeleton comes in, as a distributed lock waiting for its
+    token does. With a bounded number of threads, such calls can take
+    them all and starve the one that would free them, so there is no
+    bound here. Threads are reused, and exit once they have been idle
+    for idle_time seconds.
+
+    """
+
+    _names = itertools.count()
+
+    def __init__(self, idle_time=10.0):
+        self.idle_time = idle_time
+        self.jobs = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        # Waiting threads that no submitted job has been promised to
+        self.idle = 0
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            spawn = self.idle == 0
+            if not spawn:
+                self.idle -= 1
+        self.jobs.put((future, fn, args, kwargs))
+        if spawn:
+            threading.Thread(target=self._work, daemon=True,
+                             name="skel-{}".format(next(self._names))).start()
+        return future
+
+    def _work(self):
+        while True:
+            try:
+                future, fn, args, kwargs = self.jobs.get(
+                    timeout=self.idle_time)
+            except queue.Empty:
+                with self.lock:
+                    if self.idle == 0:
+                        # Every waiting thread has been promised a job,
+                        # this one included.
+                        continue
+                    self.idle -= 1
+                return
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            # Do not keep the call alive while waiting for the next one
+            del future, fn, args, kwargs
+            with self.lock:
+                self.idle += 1
+
+
+def _handle(owner, conn, first):
+    """Serve one incoming request on the owner object of the skeleton.
+
+    Returns True if the connection is kept open for further requests.
+
+    """
+    keep = False
+    try:
+        if first and conn.recv(1, socket.MSG_PEEK) == b"{":
+            # Newline-delimited JSON, one request per connection.
+            request = _json_loads(_recv_line(conn))
+            result = _process_request(owner, request)
+            conn.sendall(_encode_response(result, LINE_JSON))
+        else:
+            frame = recv_frame(conn, reuse=True)
+            if frame is not None:
+                request, wire = _decode(frame)
+                # Process the request and answer in the caller's format.
+                result = _process_request(owner, request)
+                send_frame(conn, _encode_response(result, wire))
+                keep = True
+    except Exception as e:
+        # Catch all errors in order to prevent the object from crashing
+        # due to bad connections coming from outside.
+        print("The connection to the caller has died:")
+        print("\t{}: {}".format(type(e), e))
+    finally:
+        if not keep:
+            conn.close()
+    return keep
 
-    def run(self):
-        try:
-            # Threat the socket as a file stream.
-            worker = self.conn.makefile(mode="rw")
-            # Read the request in a serialized form (JSON).
-            request = worker.readline()
-            # Process the request.
-            result = self.process_request(request)
-            # Send the result.
-            worker.write(result + '\n')
-            worker.flush()
-        except Exception as e:
-            # Catch all errors in order to prevent the object from crashing
-            # due to bad connections coming from outside.
-            print("The connection to the caller has died:")
-            print("\t{}: {}".format(type(e), e))
-        finally:
-            self.conn.close()
 
 class Skeleton(threading.Thread):
 
@@ -160,26 +682,83 @@ class Skeleton(threading.Thread):
     This is used to listen to an address of the network, manage incoming
     connections and forward calls to the generic owner class.
 
+    Open connections are watched with a selector; when a request
+    arrives on one, it is served by a worker thread, which hands the
+    connection back to the selector after it has been quiet for linger
+    seconds. Callers keeping idle connections open therefore do not
+    hold on to workers.
+
     """
 
-    def __init__(self, owner, address):
+    def __init__(self, owner, address, linger=0.002):
         threading.Thread.__init__(self)
         self.address = address
         self.owner = owner
         self.daemon = True
-        
+        self.linger = linger
+
+        self.pool = _WorkerPool()
+        self.selector = selectors.DefaultSelector()
+        # Connections handed back by the workers, and a socket pair used
+        # to wake up the selector when there are some.
+        self.ready = queue.SimpleQueue()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.bind(self.address)
-        self.socket.listen(1)
+        self.socket.listen(128)
+
+    def _serve(self, conn, first):
+        try:
+            keep = _handle(self.owner, conn, first)
+            # Requests following each other closely are served right
+            # away; the connection goes back to the selector once it is
+            # quiet.
+            while keep and _readable(conn, self.linger):
+                keep = _handle(self.owner, conn, False)
+        except Exception as e:
+            # Nobody waits on the worker's future, so this would be lost.
+            print("The connection to the caller has died:")
+            print("\t{}: {}".format(type(e), e))
+            conn.close()
+            return
+        if keep:
+            self.ready.put(conn)
+            self.wakeup_w.send(b"\0")
 
     def run(self):
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
         while True:
-            try:
-                conn, addr = self.socket.accept()
-                request = Request(self.owner, conn, addr)
-                request.start()
-            except Exception as e:
-                raise e 
+            for key, _ in self.selector.select():
+                if key.fileobj is self.socket:
+                    conn, addr = self.socket.accept()
+                    _configure(conn)
+                    self.selector.register(conn, selectors.EVENT_READ, True)
+                elif key.fileobj is self.wakeup_r:
+                    self.wakeup_r.recv(4096)
+                    while not self.ready.empty():
+                        self.selector.register(self.ready.get(),
+                                               selectors.EVENT_READ, False)
+                else:
+                    # Watch the connection again once the request is served.
+                    self.selector.unregister(key.fileobj)
+                    self.pool.submit(self._serve, key.fileobj, key.data)
+
+
+@functools.lru_cache(maxsize=256)
+def _resolve(host):
+    """Resolve a host name to its first non-loopback address."""
+    addrs = socket.gethostbyname_ex(host)[2]
+    if len(addrs) == 0:
+        raise CommunicationError("CommunicationError",
+                                 ["Invalid address to listen to"])
+    elif len(addrs) == 1:
+        return addrs[0]
+    else:
+        al = [a for a in addrs if a != "127.0.0.1"]
+        return al[0]
+
 
 class Peer:
 
@@ -192,7 +771,7 @@ class Peer:
         self.address = self._get_external_interface(l_address)
         self.skeleton = Skeleton(self, self.address)
         self.name_service_address = self._get_external_interface(ns_address)
-        self.name_service = Stub(self.name_service_address)
+        self.name_service = Stub(self.name_service_address, LINE_JSON)
 
     # Private methods
 
@@ -205,17 +784,16 @@ class Peer:
         """
 
         addr_name = address[0]
-        if addr_name != "":
-            addrs = socket.gethostbyname_ex(addr_name)[2]
-            if len(addrs) == 0:
-                raise CommunicationError("Invalid address to listen to")
-            elif len(addrs) == 1:
-                addr_name = addrs[0]
-            else:
-                al = [a for a in addrs if a != "127.0.0.1"]
-                addr_name = al[0]
+        if addr_name == "":
+            return tuple(address)
+        try:
+            # Already an IP address, nothing to resolve.
+            ipaddress.ip_address(addr_name)
+            return tuple(address)
+        except ValueError:
+            pass
         addr = list(address)
-        addr[0] = addr_name
+        addr[0] = _resolve(addr_name)
         return tuple(addr)
 
     # Public methods
@@ -28,6 +28,11 @@ The implementation should satisfy the following requests:
 
 """
 
+import asyncio
+import threading
+
+from Common import orb
+
 NO_TOKEN = 0
 TOKEN_PRESENT = 1
 TOKEN_HELD = 2
@@ -51,6 +56,9 @@ class DistributedLock(object):
 
     """
 
+    __slots__ = ("peer_list", "owner", "time", "token", "request", "state",
+                 "async_peers", "loop")
+
     def __init__(self, owner, peer_list):
         self.peer_list = peer_list
         self.owner = owner
@@ -58,6 +66,12 @@ class DistributedLock(object):
         self.token = None
         self.request = {}
         self.state = NO_TOKEN
+        # Event loop broadcasting the token requests, and the AsyncStubs
+        # it uses to reach the peers. The stubs are only run on the loop;
+        # the dict is protected by the lock of peer_list like the rest.
+        self.async_peers = {}
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
 
     def _prepare(self, token):
         """Prepare the token to be sent as a JSON message.
@@ -66,11 +80,7 @@ class DistributedLock(object):
         a dictionary must be a string whild in the token the key is
         integer.
         """
-        return list(token.items())
-
-    def _unprepare(self, token):
-        """The reverse operation to the one above."""
-        return dict(token)
+        return tuple(token.items())
 
     def get_order(self):
         higher = []
@@ -132,36 +142,50 @@ class DistributedLock(object):
         give it to someone else.
 
         """
-        self.peer_list.lock.acquire()
-        self.time += 1
-        # release has its own try-catch
-        if self.state != NO_TOKEN:
+        try:
+            self.peer_list.lock.acquire()
+            self.time += 1
+            state = self.state
             self.peer_list.lock.release()
-            self.release()
+
+            # release has its own locking
+            if state != NO_TOKEN:
+                self.release()
+
             self.peer_list.lock.acquire()
+            try:
+                if self.state != TOKEN_PRESENT:
+                    return
+                # No one to claim the token => Just give it to next in line
+                peers = self.peer_list.get_peers()
+                candidates = [(pid, peers[pid]) for pid in self.get_order()]
+                token = dict(self.token)
+                self.state = NO_TOKEN
+            finally:
+                self.peer_list.lock.release()
 
-        # No one to claim the token => Just give it to next in line
-        if self.state == TOKEN_PRESENT:
-            order = self.get_order()
-            for peer_id in order:
-                try:
-                    peer = self.peer_list.peer(peer_id)
-                    # Send the token to next in line
-                    self.peer_list.lock.release()
-                    peer.obtain_token(self._prepare(self.token))
-                    self.peer_list.lock.acquire()
-                    self.state = NO_TOKEN
-                    break
-                except Exception as e:
-                    # There is no need to remove it since we are about to remove the whole list anyway.
-                    print("Could not send token. Peer is down.")
-                    self.peer_list.lock.acquire()
-                    continue
-                        
-        self.peer_list.lock.release()
-        
-        
-            
+            receiver, dead = self._pass_token(candidates, token)
+            self.peer_list.lock.acquire()
+            try:
+                self._purge(dead)
+                if receiver is None:
+                    self.state = TOKEN_PRESENT
+            finally:
+                self.peer_list.lock.release()
+        finally:
+            self._stop_loop()
+
+    def _stop_loop(self):
+        """Close the connections to the peers and stop the event loop,
+        which has nothing left to broadcast."""
+        self.peer_list.lock.acquire()
+        try:
+            for peer_id in list(self.async_peers):
+                self._drop_async_peer(peer_id)
+        finally:
+            self.peer_list.lock.release()
+        # Runs after the stubs have been closed
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
     def register_peer(self, pid):
         """Called when a new peer joins the system."""
@@ -178,92 +202,191 @@ class DistributedLock(object):
         self.time += 1
         del self.request[pid]
         del self.token[pid]
+        self._drop_async_peer(pid)
         self.peer_list.lock.release()
 
     def acquire(self):
         """Called when this object tries to acquire the lock."""
         print("Trying to acquire the lock...")
-        self.peer_list.lock.acquire()        
+        self.peer_list.lock.acquire()
         self.time += 1
-        if self.state == NO_TOKEN:
-           
-            peers = self.peer_list.get_peers()
-            for peer_id in peers:
-                try:
-                    # We need to release the lock in order for the called peer to not lock down
-                    # Otherwise the other peer would lock-down but would not be able to access 
-                    # the time and id sent from us, thus would not be able to continue to function
-                    # while we have not released the lock.
-                    self.peer_list.lock.release()
-                    self.peer_list.peer(peer_id).request_token(self.time, self.owner.id)
-                    
-                except Exception as e:
-                    # Peer has failed and is down, remove it
-                    self.peer_list.lock.acquire()
-                    del self.request[peer_id]
-                    del self.token[peer_id]
-                    self.peer_list.unregister_peer(peer_id)                    
-                    self.peer_list.lock.release()
-                finally:
-                    self.peer_list.lock.acquire()
-                    
-
-            # Wait until token is received
-            while self.state != TOKEN_PRESENT:
-                print("Waiting...")
-                self.peer_list.lock.wait() # Suspend peer until notified
-                
-        # Enter CS
+        if self.state != NO_TOKEN:
+            self._enter()
+            return
+
+        # Take what the broadcast needs while holding the lock, then
+        # release it. Otherwise the called peers, which call back
+        # obtain_token on us while answering, would lock down.
+        stubs = [(peer_id, self._async_peer(peer_id, peer))
+                 for peer_id, peer in self.peer_list.get_peers().items()]
+        my_time = self.time
+        my_id = self.owner.id
+        self.peer_list.lock.release()
+
+        dead = asyncio.run_coroutine_threadsafe(
+            self._broadcast(stubs, my_time, my_id), self.loop).result()
+        self._wait_for_token(dead)
+
+    async def _broadcast(self, stubs, time, pid):
+        """Send the token request to all the (pid, AsyncStub) peers at
+        once, so that it costs about one round trip instead of one per
+        peer. Returns the ids of the peers found dead.
+
+        Runs on self.loop and must not take the lock.
+
+        """
+        results = await asyncio.gather(
+            *(self._request(stub, time, pid) for peer_id, stub in stubs),
+            return_exceptions=True)
+        return [peer_id for (peer_id, stub), result in zip(stubs, results)
+                if isinstance(result, Exception)]
+
+    async def _request(self, stub, time, pid):
+        """Send the token request to one peer, raising if it is down.
+
+        request_token may pass the token on before it answers, so a
+        slow answer does not mean the peer is down. Each time the
+        request outlasts the timeout of the stub, the peer is asked
+        whether it is still there instead, and only a peer that fails
+        to answer that is taken to be down.
+
+        """
+        call = asyncio.ensure_future(stub.request_token(time, pid))
+        while True:
+            done, _ = await asyncio.wait((call,), timeout=stub.timeout())
+            if done:
+                return call.result()
+            try:
+                await asyncio.wait_for(stub.check(), stub.timeout())
+            except BaseException:
+                call.cancel()
+                raise
+
+    def _async_peer(self, peer_id, peer):
+        """Return the AsyncStub reaching the peer behind a Stub. The lock
+        must be held."""
+        stub = self.async_peers.get(peer_id)
+        if stub is None:
+            stub = orb.AsyncStub(peer.address, peer.wire)
+            self.async_peers[peer_id] = stub
+        return stub
+
+    def _drop_async_peer(self, peer_id):
+        """Close the connections of the AsyncStub of a departed peer. The
+        lock must be held."""
+        stub = self.async_peers.pop(peer_id, None)
+        if stub is not None:
+            # Its connections belong to the loop
+            self.loop.call_soon_threadsafe(stub.close)
+
+    def _wait_for_token(self, dead):
+        """Remove the dead peers, then wait for the token and enter the
+        critical section."""
+        self.peer_list.lock.acquire()
+        self._purge(dead)
+
+        # Wait until token is received
+        while self.state != TOKEN_PRESENT:
+            print("Waiting...")
+            self.peer_list.lock.wait() # Suspend peer until notified
+        self._enter()
+
+    def _enter(self):
+        """Enter the critical section. The lock must be held and is
+        released."""
         print("Lock acquired, entering critical section...")
         self.state = TOKEN_HELD
         self.token[self.owner.id] = self.time
         self.peer_list.lock.release()
-        
+
+    def _purge(self, pids):
+        """Forget the given peers, found to be down, all under one
+        acquire of the peer list lock."""
+        if not pids:
+            return
+        with self.peer_list.lock:
+            peers = self.peer_list.get_peers()
+            for pid in pids:
+                self.request.pop(pid, None)
+                self.token.pop(pid, None)
+                self._drop_async_peer(pid)
+                # It may have been unregistered by someone else already
+                if pid in peers:
+                    self.peer_list.unregister_peer(pid)
+
+    def _pass_token(self, candidates, token):
+        """Send the token to the first of the (pid, peer) candidates
+        that is still alive.
+
+        Must be called without holding the lock. Returns the id of the
+        peer that got the token, or None, and the ids of the peers
+        found dead on the way.
+
+        """
+        dead = []
+        for peer_id, peer in candidates:
+            try:
+                peer.obtain_token(self._prepare(token))
+                print("Token sent to: " + str(peer_id))
+                return peer_id, dead
+            except Exception:
+                # If we could not send the token, try the next peer
+                print("Could not send token to: {}".format(peer_id))
+                dead.append(peer_id)
+                del token[peer_id]
+        return None, dead
 
     def release(self):
         """Called when this object releases the lock."""
         print("Releasing the lock...")
-        # Lock list since we do not want any modifications to the list while we try to send token
+        # Lock list since we do not want any modifications to the list while we pick the receiver
         self.peer_list.lock.acquire()
-        self.time += 1
+        try:
+            self.time += 1
 
-        # If we released the token ourselves then update token times
-        if self.state == TOKEN_HELD:
-            self.token[self.owner.id] = self.time
-            self.state = TOKEN_PRESENT
+            # If we released the token ourselves then update token times
+            if self.state == TOKEN_HELD:
+                self.token[self.owner.id] = self.time
+                self.state = TOKEN_PRESENT
 
-        if self.state == TOKEN_PRESENT:
-            order = self.get_order()
-            try:
-                for peer_id in order:
-                    peer = self.peer_list.peer(peer_id)
-                    if self.request[peer_id] > self.token[peer_id]:
-                        try:
-                            # Try to send the token
-                            self.peer_list.lock.release()
-                            peer.obtain_token(self._prepare(self.token))
-                            self.peer_list.lock.acquire()
-                            self.state = NO_TOKEN
-                            print("Token sent to: " + str(peer_id))
-                            break
-                        except Exception:
-                            # If we could not send the token, remove it and continue to the next peer
-                            print("Could not send token to: {}".format(peer_id))
-                            self.state = TOKEN_PRESENT
-                            del self.request[peer_id]
-                            del self.token[peer_id]
-                            self.peer_list.unregister_peer(peer_id)
-                            continue
-
-                # If no one has claimed the token
-                if self.state == TOKEN_PRESENT:
-                    print("No one claimed the token.")
-            except Exception as e:
-                # Unexpected error
-                print("Exception: {}".format(e))
-            finally:
-                self.peer_list.lock.release()
-        
+            # Also reached without the token, when a concurrent call
+            # has already passed it on.
+            if self.state != TOKEN_PRESENT:
+                return
+
+            peers = self.peer_list.get_peers()
+            candidates = [(pid, peers[pid]) for pid in self.get_order()
+                          if self.request[pid] > self.token[pid]]
+            if not candidates:
+                print("No one claimed the token.")
+                return
+
+            # Give up the token before releasing the lock, so that a
+            # concurrent call cannot send it a second time.
+            token = dict(self.token)
+            self.state = NO_TOKEN
+        finally:
+            self.peer_list.lock.release()
+
+        receiver, dead = self._pass_token(candidates, token)
+
+        # Remove the peers that are down, and take the token back if
+        # none of the candidates could receive it.
+        retry = False
+        self.peer_list.lock.acquire()
+        try:
+            self._purge(dead)
+            if receiver is None:
+                print("No one claimed the token.")
+                self.state = TOKEN_PRESENT
+                self.peer_list.lock.notify_all()
+                # Requests that came in meanwhile saw no token here.
+                retry = any(self.request[pid] > self.token[pid]
+                            for pid in self.peer_list.get_peers())
+        finally:
+            self.peer_list.lock.release()
+        if retry:
+            self.release()
 
     def request_token(self, time, pid):
         """Called when some other object requests the token from us."""
@@ -281,13 +404,15 @@ class DistributedLock(object):
         self.peer_list.lock.acquire()
         self.time += 1
         try:
-            msg = self._unprepare(token)
-            for peer_id in msg:
-                self.token[peer_id] = msg[peer_id]
-                self.time = max(self.time, msg[peer_id]+1)
-        except KeyError as k:
-            # The sender might have crashed after sending the token
-            print("No such index: {}.".format(k))
+            # Merge the (peer_id, time) pairs of the token in one pass
+            t = self.time
+            tok = self.token
+            for peer_id, peer_time in token:
+                peer_id = int(peer_id)
+                tok[peer_id] = peer_time
+                if peer_time >= t:
+                    t = peer_time + 1
+            self.time = t
         except Exception as e:
             print("Unknown error occurred: {}.".format(e))
         finally:
@@ -9,49 +9,135 @@
 
 """Implementation of a simple database class."""
 
+import re
 import random
+import itertools
+import threading
+from array import array
+
+from Common import orb
 
 
 class Database(object):
 
-    """Class containing a database implementation."""
+    """Class containing a database implementation.
+
+    The fortunes are kept UTF-8 encoded, one after the other, in a
+    single arena; fortune i spans arena[offsets[i]:offsets[i + 1]].
+    This costs two objects however many fortunes there are, instead of
+    one string each.
+
+    """
+
+    __slots__ = ("db_file", "arena", "offsets", "lock")
 
     def __init__(self, db_file):
         self.db_file = db_file
-        self.rand = random.Random()
-        self.rand.seed()
 
-        self.fortuneList = []
+        self.arena = bytearray()
+        self.offsets = array("I", [0])
+        # Serializes writers; readers only see fortunes that are
+        # complete, since the offset is appended last.
+        self.lock = threading.Lock()
         self.__read_from_database()
         pass
 
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def fortune(self, i):
+        """Return the i-th fortune of the database."""
+        offsets = self.offsets
+        return self.arena[offsets[i]:offsets[i + 1]].decode()
+
     def read(self):
         """Read a random location in the database."""
-        tmpRand = self.rand.randint(0, len(self.fortuneList)-1)
-        return self.fortuneList[tmpRand]
+        return self.fortune(random.randrange(len(self)))
 
     def write(self, fortune):
         """Write a new fortune to the database."""
-        self.fortuneList.append(fortune)
+        with self.lock:
+            self._append(fortune)
         self.__update_database(fortune)
 
+    def _append(self, fortune):
+        """Add a fortune to the arena. The lock must be held."""
+        self.arena += fortune.encode()
+        self.offsets.append(len(self.arena))
+
     def __read_from_database(self):
-        self.f = open(self.db_file, "r")
-        tmp = ""
-        for line in self.f:
-            if line == "%\n":
-                self.fortuneList.append(tmp)
-                tmp = ""
-                continue
-            else:
-                tmp += line
-        self.f.close()
+        # Fortunes are terminated by a line holding a single '%'. Empty
+        # fortunes count, and text after the last such line does not.
+        with open(self.db_file, "r") as f:
+            data = f.read().encode()
+        parts = re.split(rb"^%\n", data, flags=re.M)[:-1]
+        self.arena = bytearray().join(parts)
+        self.offsets = array("I", itertools.accumulate(
+            (len(s) for s in parts), initial=0))
 
     def __update_database(self, fortune):
-        self.f = open(self.db_file, "a")
-        self.f.write(fortune + "\n")
-        self.f.write("%\n")
-        self.f.close()
-        
-        
+        with open(self.db_file, "a", buffering=-1) as f:
+            f.write("{}\n%\n".format(fortune))
+
+
+class CachedDatabase(Database):
+
+    """Database for a Skeleton owner, answering reads with responses
+    encoded in advance.
+
+    The {"result": fortune} response of every fortune is encoded once
+    in the given wire format and kept in a second arena, laid out as
+    the first one. read() returns an orb.EncodedResult that slices the
+    picked response out of it, so the Skeleton sends the stored bytes
+    instead of encoding the fortune on every call. Fortunes are only
+    ever appended, so the responses grow with write() and nothing has
+    to be invalidated.
+
+    """
+
+    __slots__ = ("wire", "responses", "response_offsets")
+
+    def __init__(self, db_file, wire=orb.DEFAULT_WIRE):
+        Database.__init__(self, db_file)
+        self.wire = wire
+        bodies = [orb.EncodedResult(self.fortune(i)).body(wire)
+                  for i in range(len(self))]
+        self.responses = bytearray().join(bodies)
+        self.response_offsets = array("I", itertools.accumulate(
+            (len(b) for b in bodies), initial=0))
+
+    def response(self, i):
+        """Return the encoded response for the i-th fortune."""
+        offsets = self.response_offsets
+        return self.responses[offsets[i]:offsets[i + 1]]
+
+    def read(self):
+        """Read a random location in the database."""
+        return _StoredResult(self, random.randrange(len(self)))
+
+    def _append(self, fortune):
+        # The response goes in first: a fortune is only visible to
+        # readers once Database._append has stored its offset.
+        self.responses += orb.EncodedResult(fortune).body(self.wire)
+        self.response_offsets.append(len(self.responses))
+        Database._append(self, fortune)
+
+
+class _StoredResult(orb.EncodedResult):
+
+    """Result of CachedDatabase.read(), taken from the stored arenas
+    when the Skeleton asks for it."""
+
+    def __init__(self, db, i):
+        self.db = db
+        self.i = i
+
+    @property
+    def value(self):
+        return self.db.fortune(self.i)
 
+    def body(self, wire):
+        if wire != self.db.wire:
+            # Not stored in that format, encode it this once
+            return orb.EncodedResult(self.value).body(wire)
+        return self.db.response(self.i)